@@ -1,13 +1,27 @@
+import asyncio
+import csv
+import io
 import os
 import json
-from datetime import datetime, timedelta, timezone
+import time
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
 from typing import List, Optional, Dict
 
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import Depends, FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import PlainTextResponse, StreamingResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+# Serialize responses with orjson when available (C-implemented, much
+# faster on large payloads); fall back to the stdlib-json response class
+try:
+    import orjson  # noqa: F401
+    from fastapi.responses import ORJSONResponse as DefaultResponse
+except Exception:
+    DefaultResponse = JSONResponse
 
 from pydantic import BaseModel
+from pymongo import UpdateOne
 
 from database import db, create_document, get_documents
 from schemas import Business, Staff, Service, Availability, Appointment, Reminder, AvailabilityBlock
@@ -26,15 +40,45 @@ try:
 except Exception:
     TwilioClient = None
 
+try:
+    import httpx
+except Exception:
+    httpx = None
+
+# Shared HTTP client so outbound calls reuse pooled keep-alive connections
+# instead of paying a new TCP+TLS handshake per send
+http_client = httpx.AsyncClient(timeout=10) if httpx else None
+
+# Optional Redis-backed rate limiter for the public hot path
+try:
+    from fastapi_limiter import FastAPILimiter
+    from fastapi_limiter.depends import RateLimiter
+except Exception:
+    FastAPILimiter = None
+    RateLimiter = None
+
+# Optional response cache (fastapi-cache2); server runs fine without it
+try:
+    from fastapi_cache import FastAPICache
+    from fastapi_cache.decorator import cache
+except Exception:
+    FastAPICache = None
+
+    def cache(*args, **kwargs):  # no-op decorator fallback
+        def decorator(fn):
+            return fn
+        return decorator
+
 # Config
 STRIPE_SECRET = os.getenv("STRIPE_SECRET")
 STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
 FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:3000")
+REDIS_URL = os.getenv("REDIS_URL")
 
 if stripe and STRIPE_SECRET:
     stripe.api_key = STRIPE_SECRET
 
-app = FastAPI(title="Booking SaaS API")
+app = FastAPI(title="Booking SaaS API", default_response_class=DefaultResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -44,11 +88,109 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+@app.on_event("startup")
+async def ensure_indexes():
+    # Declare indexes for the hot query shapes (slot generation, dashboard
+    # listing, reminder windows). create_index is a no-op when it already exists.
+    if db is None:
+        return
+    try:
+        await db["business"].create_index("slug", unique=True)
+        await db["appointment"].create_index([("business_id", 1), ("staff_id", 1), ("status", 1), ("start_iso", 1)])
+        await db["appointment"].create_index([("status", 1), ("start_iso", 1)])
+        await db["availability"].create_index([("business_id", 1), ("staff_id", 1)], unique=True)
+        await db["service"].create_index("business_id")
+        await db["staff"].create_index([("business_id", 1), ("active", 1)])
+        await db["reminder"].create_index("status")
+    except Exception as e:
+        # Never block startup on index creation (e.g. insufficient privileges)
+        print("Index creation failed:", e)
+
+
+@app.on_event("startup")
+async def init_cache():
+    if not FastAPICache:
+        return
+    try:
+        if REDIS_URL:
+            from redis import asyncio as aioredis
+            from fastapi_cache.backends.redis import RedisBackend
+            backend = RedisBackend(aioredis.from_url(REDIS_URL))
+        else:
+            from fastapi_cache.backends.inmemory import InMemoryBackend
+            backend = InMemoryBackend()
+        FastAPICache.init(backend, prefix="booking")
+    except Exception as e:
+        print("Cache init failed:", e)
+
+
+@app.on_event("startup")
+async def init_rate_limiter():
+    if not (FastAPILimiter and REDIS_URL):
+        return
+    try:
+        from redis import asyncio as aioredis
+        await FastAPILimiter.init(aioredis.from_url(REDIS_URL, encoding="utf-8", decode_responses=True))
+    except Exception as e:
+        print("Rate limiter init failed:", e)
+
+
+# Fallback buckets for single-process deployments without Redis
+_local_buckets: Dict[str, tuple] = {}
+
+
+def rate_limit(times: int, seconds: int):
+    """Per-client rate limit dependency for the expensive public routes.
+
+    Uses the shared Redis limiter when configured; otherwise falls back to a
+    small in-memory token bucket keyed by client IP + path (the path already
+    carries the business slug).
+    """
+    limiter = RateLimiter(times=times, seconds=seconds) if RateLimiter else None
+
+    async def dependency(request: Request, response: Response):
+        if limiter and getattr(FastAPILimiter, "redis", None):
+            await limiter(request, response)
+            return
+        key = f"{request.client.host if request.client else 'anon'}:{request.url.path}"
+        now = time.monotonic()
+        tokens, last = _local_buckets.get(key, (float(times), now))
+        tokens = min(float(times), tokens + (now - last) * times / seconds)
+        if tokens < 1:
+            raise HTTPException(429, "Too many requests")
+        if len(_local_buckets) > 10_000:  # keep the fallback map bounded
+            _local_buckets.clear()
+        _local_buckets[key] = (tokens - 1, now)
+
+    return Depends(dependency)
+
+
+@app.on_event("shutdown")
+async def close_http_client():
+    if http_client:
+        await http_client.aclose()
+
+
+async def invalidate_public_cache():
+    # Drop cached public pages after admin writes; no-op when the cache is off
+    if FastAPICache:
+        try:
+            await FastAPICache.clear(namespace="public_business")
+        except Exception:
+            pass
+
 # Utility
 
+@lru_cache(maxsize=4096)
+def _oid_cached(s: str) -> ObjectId:
+    # ObjectId is immutable, so caching the hex validation + parse is safe
+    return ObjectId(s)
+
+
 def oid(s: str) -> ObjectId:
     try:
-        return ObjectId(s)
+        return _oid_cached(s)
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid ID")
 
@@ -69,6 +211,69 @@ def minutes_between(iso_start: str, minutes: int) -> str:
     return utc_iso(start + timedelta(minutes=minutes))
 
 
+def day_range_filter(day: date) -> dict:
+    """Half-open [day, next day) filter on start_iso.
+
+    A range predicate can seek through the compound b-tree index, unlike the
+    anchored $regex match this replaced, which had to scan string keys.
+    """
+    next_day = day + timedelta(days=1)
+    return {
+        "$gte": day.isoformat() + "T00:00:00+00:00",
+        "$lt": next_day.isoformat() + "T00:00:00+00:00",
+    }
+
+
+class IntervalTree:
+    """Static augmented interval tree over half-open [start, end) intervals.
+
+    Built once from a list of (start, end) pairs (balanced by median split),
+    then answers overlap queries in O(log n) instead of scanning every
+    interval. Used by generate_slots to test candidate slots against the
+    day's appointments.
+    """
+
+    __slots__ = ("start", "end", "max_end", "left", "right")
+
+    def __init__(self, start: int, end: int):
+        self.start = start
+        self.end = end
+        self.max_end = end
+        self.left: Optional["IntervalTree"] = None
+        self.right: Optional["IntervalTree"] = None
+
+    @classmethod
+    def build(cls, intervals: List[tuple]) -> Optional["IntervalTree"]:
+        if not intervals:
+            return None
+        return cls._build(sorted(intervals), 0, len(intervals))
+
+    @classmethod
+    def _build(cls, intervals: List[tuple], lo: int, hi: int) -> Optional["IntervalTree"]:
+        if lo >= hi:
+            return None
+        mid = (lo + hi) // 2
+        node = cls(intervals[mid][0], intervals[mid][1])
+        node.left = cls._build(intervals, lo, mid)
+        node.right = cls._build(intervals, mid + 1, hi)
+        if node.left and node.left.max_end > node.max_end:
+            node.max_end = node.left.max_end
+        if node.right and node.right.max_end > node.max_end:
+            node.max_end = node.right.max_end
+        return node
+
+    def overlaps(self, start: int, end: int) -> bool:
+        node = self
+        while node:
+            if start < node.end and node.start < end:
+                return True
+            if node.left and node.left.max_end > start:
+                node = node.left
+            else:
+                node = node.right
+        return False
+
+
 # Schemas for requests
 class CreateBusiness(BaseModel):
     name: str
@@ -126,9 +331,10 @@ def root():
 
 
 @app.get("/test")
-def test_database():
+@cache(expire=60)
+async def test_database():
     try:
-        collections = db.list_collection_names()
+        collections = await db.list_collection_names()
         return {
             "backend": "✅ Running",
             "database": "✅ Connected",
@@ -140,9 +346,9 @@ def test_database():
 
 # Business
 @app.post("/api/business")
-def create_business(payload: CreateBusiness):
+async def create_business(payload: CreateBusiness):
     # ensure unique slug
-    if db["business"].find_one({"slug": payload.slug}):
+    if await db["business"].find_one({"slug": payload.slug}):
         raise HTTPException(status_code=400, detail="Slug already in use")
     biz = Business(
         name=payload.name,
@@ -150,26 +356,46 @@ def create_business(payload: CreateBusiness):
         timezone=payload.timezone,
         currency=payload.currency,
         deposit_percent_default=payload.deposit_percent_default,
+        # Generate private ics token up front so one insert covers it
+        ics_token=str(ObjectId()),
     )
-    _id = create_document("business", biz)
-    # Generate private ics token
-    token = str(ObjectId())
-    db["business"].update_one({"_id": ObjectId(_id)}, {"$set": {"ics_token": token}})
-    saved = db["business"].find_one({"_id": ObjectId(_id)})
-    saved["_id"] = str(saved["_id"])
+    _id = await create_document("business", biz)
+    saved = biz.model_dump()
+    saved["_id"] = _id
     return saved
 
 
 @app.get("/api/b/{slug}")
-def public_business(slug: str):
-    biz = db["business"].find_one({"slug": slug})
-    if not biz:
+@cache(expire=60, namespace="public_business")
+async def public_business(slug: str):
+    # One aggregate with server-side $lookup joins instead of three
+    # sequential round-trips (business_id is stored as str, hence $toString)
+    docs = await db["business"].aggregate([
+        {"$match": {"slug": slug}},
+        {"$lookup": {
+            "from": "service",
+            "let": {"bid": {"$toString": "$_id"}},
+            "pipeline": [{"$match": {"$expr": {"$eq": ["$business_id", "$$bid"]}}}],
+            "as": "services",
+        }},
+        {"$lookup": {
+            "from": "staff",
+            "let": {"bid": {"$toString": "$_id"}},
+            "pipeline": [{"$match": {"$expr": {"$and": [
+                {"$eq": ["$business_id", "$$bid"]},
+                {"$eq": ["$active", True]},
+            ]}}}],
+            "as": "staff",
+        }},
+    ]).to_list(length=1)
+    if not docs:
         raise HTTPException(404, "Business not found")
+    biz = docs[0]
     biz["_id"] = str(biz["_id"])
-    services = list(db["service"].find({"business_id": str(biz["_id"])}))
+    services = biz.pop("services", [])
     for s in services:
         s["_id"] = str(s["_id"])
-    staff = list(db["staff"].find({"business_id": str(biz["_id"]), "active": True}))
+    staff = biz.pop("staff", [])
     for m in staff:
         m["_id"] = str(m["_id"])
     return {"business": biz, "services": services, "staff": staff}
@@ -177,120 +403,182 @@ def public_business(slug: str):
 
 # Staff
 @app.post("/api/staff")
-def add_staff(payload: CreateStaff):
-    if not db["business"].find_one({"_id": oid(payload.business_id)}):
+async def add_staff(payload: CreateStaff):
+    if not await db["business"].find_one({"_id": oid(payload.business_id)}):
         raise HTTPException(400, "Business not found")
     staff = Staff(**payload.model_dump())
-    _id = create_document("staff", staff)
-    doc = db["staff"].find_one({"_id": ObjectId(_id)})
-    doc["_id"] = str(doc["_id"])
+    _id = await create_document("staff", staff)
+    doc = staff.model_dump()
+    doc["_id"] = _id
+    await invalidate_public_cache()
     return doc
 
 
 # Service
 @app.post("/api/service")
-def add_service(payload: CreateService):
-    if not db["business"].find_one({"_id": oid(payload.business_id)}):
+async def add_service(payload: CreateService):
+    if not await db["business"].find_one({"_id": oid(payload.business_id)}):
         raise HTTPException(400, "Business not found")
     service = Service(**payload.model_dump())
-    _id = create_document("service", service)
-    doc = db["service"].find_one({"_id": ObjectId(_id)})
-    doc["_id"] = str(doc["_id"])
+    _id = await create_document("service", service)
+    doc = service.model_dump()
+    doc["_id"] = _id
+    await invalidate_public_cache()
     return doc
 
 
 # Availability
 @app.post("/api/availability")
-def set_availability(payload: SetAvailability):
-    if not db["business"].find_one({"_id": oid(payload.business_id)}):
+async def set_availability(payload: SetAvailability):
+    if not await db["business"].find_one({"_id": oid(payload.business_id)}):
         raise HTTPException(400, "Business not found")
-    if not db["staff"].find_one({"_id": oid(payload.staff_id)}):
+    if not await db["staff"].find_one({"_id": oid(payload.staff_id)}):
         raise HTTPException(400, "Staff not found")
     av = Availability(**payload.model_dump())
+    doc = av.model_dump()
+    # Normalize weekday keys to strings on write (Mongo stores them as
+    # strings anyway) so reads are a single dict lookup
+    doc["weekly"] = {str(k): v for k, v in doc["weekly"].items()}
     # upsert by business + staff
-    db["availability"].update_one(
+    await db["availability"].update_one(
         {"business_id": av.business_id, "staff_id": av.staff_id},
-        {"$set": av.model_dump()},
+        {"$set": doc},
         upsert=True,
     )
-    doc = db["availability"].find_one({"business_id": av.business_id, "staff_id": av.staff_id})
+    doc = await db["availability"].find_one({"business_id": av.business_id, "staff_id": av.staff_id})
     if doc and "_id" in doc:
         doc["_id"] = str(doc["_id"])
+    await invalidate_public_cache()
     return doc
 
 
 # Slot generation helper
 
-def generate_slots(biz: dict, staff_id: str, service: dict, date_str: str, increment: int = 15) -> List[str]:
-    # date_str in business timezone is assumed; we treat as local day and produce UTC ISO start strings for slots
+@lru_cache(maxsize=1024)
+def _slot_grid(blocks: tuple, duration_total: int, increment: int) -> tuple:
+    """Candidate slot start offsets (minutes from midnight) for a day's blocks.
+
+    The weekly grid only changes when staff edit availability, so the grid is
+    memoized keyed by the block contents themselves — an availability update
+    produces a different key, making explicit invalidation unnecessary.
+    """
+    return tuple(
+        t
+        for start_min, end_min in blocks
+        for t in range(start_min, end_min - duration_total + 1, increment)
+    )
+
+
+async def generate_slots(biz: dict, staff_id: str, service: dict, date_str: str, increment: int = 15) -> List[datetime]:
+    # date_str in business timezone is assumed; we treat as local day and produce UTC start datetimes for slots
     # For simplicity, we consider day boundaries in local time but compute times in UTC as naive offsets
-    av = db["availability"].find_one({"business_id": str(biz["_id"]), "staff_id": staff_id})
+    av = await db["availability"].find_one({"business_id": str(biz["_id"]), "staff_id": staff_id})
     if not av:
         return []
-    weekday = datetime.fromisoformat(date_str + "T00:00:00+00:00").weekday()  # 0=Mon
-    day_blocks = av.get("weekly", {}).get(str(weekday)) or av.get("weekly", {}).get(weekday) or []
+    day = date.fromisoformat(date_str)  # cheaper than a full tz-aware datetime parse
+    weekday = day.weekday()  # 0=Mon
+    weekly = av.get("weekly") or {}
+    day_blocks = weekly.get(str(weekday), [])
 
     # Fetch existing appointments to block overlaps
-    appts = list(db["appointment"].find({
+    appts = await db["appointment"].find({
         "business_id": str(biz["_id"]),
         "staff_id": staff_id,
         "status": {"$in": ["pending", "confirmed"]},
-        "start_iso": {"$regex": f"^{date_str}"},
-    }))
-
-    def overlaps(a_start: datetime, a_end: datetime, b_start: datetime, b_end: datetime) -> bool:
-        return not (a_end <= b_start or a_start >= b_end)
+        "start_iso": day_range_filter(day),
+    }, {"start_iso": 1, "end_iso": 1, "_id": 0}).to_list(length=None)
 
-    slots: List[str] = []
+    slots: List[datetime] = []
     duration_total = service["duration_min"] + service.get("buffer_before_min", 0) + service.get("buffer_after_min", 0)
 
     # Interpret date at midnight UTC for simplicity
-    day_start = datetime.fromisoformat(date_str + "T00:00:00+00:00")
+    day_start = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
 
-    for block in day_blocks:
-        start_min = block.get("start_min") if isinstance(block, dict) else block.start_min
-        end_min = block.get("end_min") if isinstance(block, dict) else block.end_min
-        t = start_min
-        while t + duration_total <= end_min:
-            slot_start = day_start + timedelta(minutes=t)
-            slot_end = slot_start + timedelta(minutes=duration_total)
-            # Check against appointments (respecting service duration + buffers)
-            conflict = False
-            for ap in appts:
-                ap_s = datetime.fromisoformat(ap["start_iso"])  # stored in UTC ISO
-                ap_e = datetime.fromisoformat(ap["end_iso"])  # includes buffers already when created
-                if overlaps(slot_start, slot_end, ap_s, ap_e):
-                    conflict = True
-                    break
-            if not conflict:
-                slots.append(utc_iso(slot_start))
-            t += increment
+    # Index appointments as minute offsets from day_start so each slot is an
+    # O(log n) tree query instead of a scan over every appointment
+    intervals = []
+    for ap in appts:
+        ap_s = datetime.fromisoformat(ap["start_iso"])  # stored in UTC ISO
+        ap_e = datetime.fromisoformat(ap["end_iso"])  # includes buffers already when created
+        intervals.append((
+            int((ap_s - day_start).total_seconds() // 60),
+            int((ap_e - day_start).total_seconds() // 60),
+        ))
+    busy = IntervalTree.build(intervals)
+
+    block_key = tuple(
+        (b.get("start_min"), b.get("end_min")) if isinstance(b, dict) else (b.start_min, b.end_min)
+        for b in day_blocks
+    )
+    for t in _slot_grid(block_key, duration_total, increment):
+        # Check against appointments (respecting service duration + buffers)
+        if not (busy and busy.overlaps(t, t + duration_total)):
+            slots.append(day_start + timedelta(minutes=t))
     return slots
 
 
-@app.post("/api/b/{slug}/slots")
-def slots(slug: str, q: SlotQuery):
-    biz = db["business"].find_one({"slug": slug})
+async def is_slot_free(biz: dict, staff_id: str, service: dict, start_dt: datetime, end_dt: datetime) -> bool:
+    """Check a single requested slot without regenerating the whole day.
+
+    Verifies the slot falls inside an availability block, is aligned to the
+    staff's slot increment, and has no overlapping pending/confirmed
+    appointment (narrow Mongo range filter instead of a full-day scan).
+    """
+    av = await db["availability"].find_one({"business_id": str(biz["_id"]), "staff_id": staff_id})
+    if not av:
+        return False
+    weekday = start_dt.weekday()
+    weekly = av.get("weekly") or {}
+    day_blocks = weekly.get(str(weekday), [])
+    increment = av.get("slot_increment_min", 15)
+
+    # Minutes from midnight of the slot's (UTC) day
+    start_min = start_dt.hour * 60 + start_dt.minute
+    end_min = start_min + int((end_dt - start_dt).total_seconds() // 60)
+
+    in_block = False
+    for block in day_blocks:
+        b_start = block.get("start_min") if isinstance(block, dict) else block.start_min
+        b_end = block.get("end_min") if isinstance(block, dict) else block.end_min
+        if b_start <= start_min and end_min <= b_end and (start_min - b_start) % increment == 0:
+            in_block = True
+            break
+    if not in_block:
+        return False
+
+    conflict = await db["appointment"].find_one({
+        "business_id": str(biz["_id"]),
+        "staff_id": staff_id,
+        "status": {"$in": ["pending", "confirmed"]},
+        "start_iso": {"$lt": utc_iso(end_dt)},
+        "end_iso": {"$gt": utc_iso(start_dt)},
+    }, {"_id": 1})
+    return conflict is None
+
+
+@app.post("/api/b/{slug}/slots", dependencies=[rate_limit(60, 60)])
+async def slots(slug: str, q: SlotQuery):
+    biz = await db["business"].find_one({"slug": slug})
     if not biz:
         raise HTTPException(404, "Business not found")
-    service = db["service"].find_one({"_id": oid(q.service_id)})
+    service = await db["service"].find_one({"_id": oid(q.service_id)})
     if not service:
         raise HTTPException(404, "Service not found")
-    av = db["availability"].find_one({"business_id": str(biz["_id"]), "staff_id": q.staff_id})
+    av = await db["availability"].find_one({"business_id": str(biz["_id"]), "staff_id": q.staff_id})
     increment = av.get("slot_increment_min", 15) if av else 15
-    times = generate_slots(biz, q.staff_id, service, q.date, increment)
-    # Return times as HH:MM based on provided date
-    formatted = [datetime.fromisoformat(t).strftime("%H:%M") for t in times]
+    times = await generate_slots(biz, q.staff_id, service, q.date, increment)
+    # Return times as HH:MM based on provided date (no ISO round-trip)
+    formatted = [t.strftime("%H:%M") for t in times]
     return {"date": q.date, "times": formatted}
 
 
-@app.post("/api/b/{slug}/book")
-def book(slug: str, payload: BookRequest):
-    biz = db["business"].find_one({"slug": slug})
+@app.post("/api/b/{slug}/book", dependencies=[rate_limit(10, 60)])
+async def book(slug: str, payload: BookRequest):
+    biz = await db["business"].find_one({"slug": slug})
     if not biz:
         raise HTTPException(404, "Business not found")
-    service = db["service"].find_one({"_id": oid(payload.service_id)})
-    staff = db["staff"].find_one({"_id": oid(payload.staff_id)})
+    service = await db["service"].find_one({"_id": oid(payload.service_id)})
+    staff = await db["staff"].find_one({"_id": oid(payload.staff_id)})
     if not service or not staff:
         raise HTTPException(400, "Invalid staff or service")
 
@@ -299,9 +587,10 @@ def book(slug: str, payload: BookRequest):
     duration_total = service["duration_min"] + service.get("buffer_before_min", 0) + service.get("buffer_after_min", 0)
     end_iso = minutes_between(start_iso, duration_total)
 
-    # Check slot availability again
-    available = slots(slug, SlotQuery(service_id=payload.service_id, staff_id=payload.staff_id, date=payload.date))
-    if payload.time not in available["times"]:
+    # Check slot availability again (single-slot check, no full-day regeneration)
+    start_dt = datetime.fromisoformat(start_iso)
+    end_dt = datetime.fromisoformat(end_iso)
+    if not await is_slot_free(biz, payload.staff_id, service, start_dt, end_dt):
         raise HTTPException(409, detail="Selected time is no longer available")
 
     amount_total = service["price_cents"]
@@ -323,7 +612,7 @@ def book(slug: str, payload: BookRequest):
         amount_cents_due_now=amount_due,
         currency=biz.get("currency", "usd"),
     )
-    appt_id = create_document("appointment", appt)
+    appt_id = await create_document("appointment", appt)
 
     # Create Stripe Checkout Session for payment (only if stripe lib and key available)
     checkout_url = None
@@ -331,7 +620,9 @@ def book(slug: str, payload: BookRequest):
         success_url = f"{FRONTEND_URL}/payment-success?appointment_id={appt_id}"
         cancel_url = f"{FRONTEND_URL}/payment-cancel?appointment_id={appt_id}"
         try:
-            session = stripe.checkout.Session.create(
+            # Stripe's client is synchronous; keep it off the event loop
+            session = await asyncio.to_thread(
+                stripe.checkout.Session.create,
                 mode="payment",
                 payment_intent_data={
                     "metadata": {
@@ -354,7 +645,7 @@ def book(slug: str, payload: BookRequest):
                 cancel_url=cancel_url,
             )
             checkout_url = session.url
-            db["appointment"].update_one({"_id": ObjectId(appt_id)}, {"$set": {"stripe_checkout_session_id": session.id}})
+            await db["appointment"].update_one({"_id": ObjectId(appt_id)}, {"$set": {"stripe_checkout_session_id": session.id}})
         except Exception as e:
             # leave without payment link if Stripe not configured correctly
             print("Stripe error:", e)
@@ -368,8 +659,14 @@ async def stripe_webhook(request: Request):
     # If stripe lib or secret missing, accept webhook without processing to avoid startup/runtime failure
     if not (stripe and STRIPE_WEBHOOK_SECRET):
         return {"received": True}
-    payload = await request.body()
     sig_header = request.headers.get("stripe-signature")
+    # Reject unsigned or oversized payloads before buffering the body
+    if not sig_header:
+        raise HTTPException(400, "Missing stripe-signature header")
+    content_length = int(request.headers.get("content-length", "0") or 0)
+    if content_length > 1_000_000:
+        raise HTTPException(413, "Payload too large")
+    payload = await request.body()
     try:
         event = stripe.Webhook.construct_event(payload, sig_header, STRIPE_WEBHOOK_SECRET)
     except Exception as e:
@@ -383,157 +680,216 @@ async def stripe_webhook(request: Request):
         else:
             appt_id = data.get("metadata", {}).get("appointment_id") or data.get("payment_intent")
         if appt_id:
-            db["appointment"].update_one({"_id": oid(appt_id)}, {"$set": {"status": "confirmed"}})
+            await db["appointment"].update_one({"_id": oid(appt_id)}, {"$set": {"status": "confirmed"}})
     return {"received": True}
 
 
 # ICS feed
 @app.get("/api/b/{slug}/ics", response_class=PlainTextResponse)
-def ics_feed(slug: str, token: str):
-    biz = db["business"].find_one({"slug": slug})
+async def ics_feed(slug: str, token: str):
+    biz = await db["business"].find_one({"slug": slug})
     if not biz:
         raise HTTPException(404, "Business not found")
     if token != biz.get("ics_token"):
         raise HTTPException(403, "Invalid token")
     # Basic ICS content
-    appts = list(db["appointment"].find({
+    appts = await db["appointment"].find({
         "business_id": str(biz["_id"]),
         "status": {"$in": ["confirmed", "completed"]},
-    }))
-    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", f"PRODID:-//BookingSaaS//EN"]
+    }, {"start_iso": 1, "end_iso": 1}).to_list(length=None)
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//BookingSaaS//EN"]
+    # DTSTAMP is identical for every event; compute it once outside the loop
+    dtstamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
     for ap in appts:
         start = datetime.fromisoformat(ap["start_iso"]).strftime("%Y%m%dT%H%M%SZ")
         end = datetime.fromisoformat(ap["end_iso"]).strftime("%Y%m%dT%H%M%SZ")
-        uid = str(ap["_id"]) + "@bookingsaas"
-        summary = "Appointment"
-        lines += [
-            "BEGIN:VEVENT",
-            f"UID:{uid}",
-            f"DTSTAMP:{datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')}",
-            f"DTSTART:{start}",
-            f"DTEND:{end}",
-            f"SUMMARY:{summary}",
-            "END:VEVENT",
-        ]
+        lines.append(
+            "BEGIN:VEVENT\r\n"
+            f"UID:{ap['_id']}@bookingsaas\r\n"
+            f"DTSTAMP:{dtstamp}\r\n"
+            f"DTSTART:{start}\r\n"
+            f"DTEND:{end}\r\n"
+            "SUMMARY:Appointment\r\n"
+            "END:VEVENT"
+        )
     lines.append("END:VCALENDAR")
     return "\r\n".join(lines)
 
 
 # Dashboard: list appointments
 @app.get("/api/appointments")
-def list_appointments(business_id: str, status: Optional[str] = None, limit: int = 200):
+async def list_appointments(business_id: str, status: Optional[str] = None, limit: int = 200):
     q: Dict = {"business_id": business_id}
     if status:
         q["status"] = status
-    appts = list(db["appointment"].find(q).sort("start_iso", 1).limit(limit))
+    appts = await db["appointment"].find(q).sort("start_iso", 1).limit(limit).to_list(length=limit)
     for a in appts:
         a["_id"] = str(a["_id"])
     return {"items": appts}
 
 
 @app.get("/api/appointments/export")
-def export_appointments(business_id: str):
-    appts = list(db["appointment"].find({"business_id": business_id}).sort("start_iso", 1))
-    def generate():
+async def export_appointments(business_id: str):
+    async def generate():
+        # csv.writer handles quoting/newlines correctly (and in C), unlike
+        # the old per-field comma replacement which corrupted values
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+
+        def row_bytes(row):
+            writer.writerow(row)
+            data = buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            return data
+
         header = [
             "id","status","start_iso","end_iso","customer_name","customer_email","customer_phone","service_id","staff_id","amount_cents_total","amount_cents_due_now","currency"
         ]
-        yield ",".join(header) + "\n"
-        for a in appts:
+        yield row_bytes(header)
+        # Iterate the cursor directly so rows stream without materializing
+        # the whole collection in memory first
+        cursor = db["appointment"].find(
+            {"business_id": business_id},
+            {
+                "status": 1, "start_iso": 1, "end_iso": 1, "customer_name": 1,
+                "customer_email": 1, "customer_phone": 1, "service_id": 1,
+                "staff_id": 1, "amount_cents_total": 1, "amount_cents_due_now": 1,
+                "currency": 1,
+            },
+        ).sort("start_iso", 1)
+        async for a in cursor:
             row = [
                 str(a.get("_id")), a.get("status",""), a.get("start_iso",""), a.get("end_iso",""),
                 a.get("customer_name",""), a.get("customer_email",""), a.get("customer_phone",""),
                 a.get("service_id",""), a.get("staff_id",""), str(a.get("amount_cents_total",0)), str(a.get("amount_cents_due_now",0)), a.get("currency","usd")
             ]
-            yield ",".join([str(x).replace(","," ") for x in row]) + "\n"
+            yield row_bytes(row)
     return StreamingResponse(generate(), media_type="text/csv")
 
 
 # Reminder cron
 @app.post("/api/cron/reminders")
-def run_reminders():
+async def run_reminders():
     now = datetime.now(timezone.utc)
     # Find confirmed appointments starting at 24h or 2h from now (tolerance 5 minutes)
     for hours in (24, 2):
         target_start = now + timedelta(hours=hours)
         start_window = target_start - timedelta(minutes=5)
         end_window = target_start + timedelta(minutes=5)
-        appts = list(db["appointment"].find({
+        appts = await db["appointment"].find({
             "status": "confirmed",
             "start_iso": {"$gte": utc_iso(start_window), "$lte": utc_iso(end_window)}
-        }))
+        }, {"business_id": 1}).to_list(length=None)
+        if not appts:
+            continue
+        # One round-trip for every business in the window instead of N find_ones
+        bids = {oid(a["business_id"]) for a in appts}
+        biz_map = {str(b["_id"]): b async for b in db["business"].find(
+            {"_id": {"$in": list(bids)}},
+            {"reminders_enabled": 1, "reminders_email_enabled": 1, "reminders_sms_enabled": 1},
+        )}
+        docs = []
         for ap in appts:
-            biz = db["business"].find_one({"_id": oid(ap["business_id"])})
+            biz = biz_map.get(ap["business_id"])
             if not biz or not biz.get("reminders_enabled", True):
                 continue
             if biz.get("reminders_email_enabled", True):
-                create_document("reminder", Reminder(
+                docs.append(Reminder(
                     business_id=ap["business_id"], appointment_id=str(ap["_id"]), kind="email",
                     scheduled_at_iso=utc_iso(now)
-                ))
+                ).model_dump())
             if biz.get("reminders_sms_enabled", False):
-                create_document("reminder", Reminder(
+                docs.append(Reminder(
                     business_id=ap["business_id"], appointment_id=str(ap["_id"]), kind="sms",
                     scheduled_at_iso=utc_iso(now)
-                ))
+                ).model_dump())
+        if docs:
+            # Bulk insert with the same timestamps create_document would set
+            ts = datetime.now(timezone.utc)
+            for d in docs:
+                d["created_at"] = ts
+                d["updated_at"] = ts
+            await db["reminder"].insert_many(docs)
     return {"queued": True}
 
 
 @app.post("/api/reminders/send")
-def send_reminders():
+async def send_reminders():
     # send queued reminders; integrate with Resend and Twilio if env vars set
     resend_key = os.getenv("RESEND_API_KEY")
     tw_sid = os.getenv("TWILIO_ACCOUNT_SID")
     tw_token = os.getenv("TWILIO_AUTH_TOKEN")
     tw_from = os.getenv("TWILIO_FROM_NUMBER")
 
-    queued = list(db["reminder"].find({"status": "queued"}).limit(50))
-    sent = 0
-    failed = 0
+    queued = await db["reminder"].find({"status": "queued"}).limit(50).to_list(length=50)
 
+    # Batch-fetch the appointments for the whole batch in one query
+    appt_ids = []
     for r in queued:
         try:
-            ap = db["appointment"].find_one({"_id": r["appointment_id"] if isinstance(r["appointment_id"], ObjectId) else oid(r["appointment_id"])})
-            if not ap:
-                db["reminder"].update_one({"_id": r["_id"]}, {"$set": {"status": "failed", "last_error": "Appointment not found"}})
-                failed += 1
-                continue
+            appt_ids.append(r["appointment_id"] if isinstance(r["appointment_id"], ObjectId) else ObjectId(r["appointment_id"]))
+        except Exception:
+            pass  # malformed id -> appointment simply won't be found
+    appt_map = {str(a["_id"]): a async for a in db["appointment"].find(
+        {"_id": {"$in": appt_ids}},
+        {"customer_name": 1, "customer_email": 1, "customer_phone": 1, "start_iso": 1},
+    )}
+
+    # Fan deliveries out concurrently; the semaphore bounds in-flight requests
+    sem = asyncio.Semaphore(10)
+
+    async def deliver(r: dict) -> tuple:
+        ap = appt_map.get(str(r["appointment_id"]))
+        if not ap:
+            return r["_id"], {"status": "failed", "last_error": "Appointment not found"}, False
+        try:
             # Email
-            if r["kind"] == "email" and resend_key and ap.get("customer_email"):
-                import requests
-                resp = requests.post(
-                    "https://api.resend.com/emails",
-                    headers={"Authorization": f"Bearer {resend_key}", "Content-Type": "application/json"},
-                    json={
-                        "from": "Bookings <noreply@bookingsaas.dev>",
-                        "to": [ap["customer_email"]],
-                        "subject": "Appointment reminder",
-                        "html": f"<p>Hi {ap.get('customer_name','')}, this is a reminder for your appointment at {ap.get('start_iso')}</p>",
-                    },
-                    timeout=10,
-                )
+            if r["kind"] == "email" and resend_key and ap.get("customer_email") and http_client is not None:
+                async with sem:
+                    resp = await http_client.post(
+                        "https://api.resend.com/emails",
+                        headers={"Authorization": f"Bearer {resend_key}", "Content-Type": "application/json"},
+                        json={
+                            "from": "Bookings <noreply@bookingsaas.dev>",
+                            "to": [ap["customer_email"]],
+                            "subject": "Appointment reminder",
+                            "html": f"<p>Hi {ap.get('customer_name','')}, this is a reminder for your appointment at {ap.get('start_iso')}</p>",
+                        },
+                    )
                 if resp.status_code >= 200 and resp.status_code < 300:
-                    db["reminder"].update_one({"_id": r["_id"]}, {"$set": {"status": "sent"}})
-                    sent += 1
-                else:
-                    db["reminder"].update_one({"_id": r["_id"]}, {"$set": {"status": "failed", "last_error": resp.text}})
-                    failed += 1
+                    return r["_id"], {"status": "sent"}, True
+                return r["_id"], {"status": "failed", "last_error": resp.text}, False
             elif r["kind"] == "sms" and tw_sid and tw_token and tw_from and ap.get("customer_phone") and TwilioClient:
-                client = TwilioClient(tw_sid, tw_token)
-                msg = client.messages.create(
-                    body=f"Reminder: appointment at {ap.get('start_iso')}",
-                    from_=tw_from,
-                    to=ap["customer_phone"],
-                )
-                db["reminder"].update_one({"_id": r["_id"]}, {"$set": {"status": "sent"}})
-                sent += 1
+                def send_sms():
+                    TwilioClient(tw_sid, tw_token).messages.create(
+                        body=f"Reminder: appointment at {ap.get('start_iso')}",
+                        from_=tw_from,
+                        to=ap["customer_phone"],
+                    )
+                async with sem:
+                    await asyncio.to_thread(send_sms)
+                return r["_id"], {"status": "sent"}, True
             else:
                 # No integration keys, mark sent to avoid infinite queue in demo
-                db["reminder"].update_one({"_id": r["_id"]}, {"$set": {"status": "sent", "last_error": "No provider configured; marked sent in demo"}})
-                sent += 1
+                return r["_id"], {"status": "sent", "last_error": "No provider configured; marked sent in demo"}, True
         except Exception as e:
-            db["reminder"].update_one({"_id": r["_id"]}, {"$set": {"status": "failed", "last_error": str(e)}})
+            return r["_id"], {"status": "failed", "last_error": str(e)}, False
+
+    results = await asyncio.gather(*(deliver(r) for r in queued))
+
+    sent = 0
+    failed = 0
+    # One bulk_write for all status updates instead of 1-2 round-trips each
+    ops: List[UpdateOne] = []
+    for rid, fields, ok in results:
+        ops.append(UpdateOne({"_id": rid}, {"$set": fields}))
+        if ok:
+            sent += 1
+        else:
             failed += 1
+    if ops:
+        await db["reminder"].bulk_write(ops, ordered=False)
     return {"sent": sent, "failed": failed}
 
 